@@ -1,20 +1,31 @@
+import logging
 import time
-from threading import RLock, Thread
-from typing import Generic, Callable, TypeVar
+from collections import OrderedDict
+from threading import Thread, Event
+from typing import Generic, Callable, TypeVar, Iterator
 
-from cachetools import TTLCache
+from cachetools import Cache
+
+from locks import RLock
 
 _K = TypeVar("_K")
 _V = TypeVar("_V")
 
+_MISSING = object()
+
+_SWEEP_INTERVAL_SECONDS: float = 1.0
+
+logger = logging.getLogger(__name__)
+
 
 class RefreshCache(Generic[_K, _V]):
-    __general_lock: RLock
+    # Reentrant: refresh_callback runs under the key's lock and may get() the same key again
     __locks: dict[_K, RLock]
     __cache: dict[_K, _V]
     __load_func: Callable[[_K, _V | None], _V]
     __refresh_callback: Callable[[_K, _V | None, _V], bool]
     __sync_interval_seconds: int
+    __stop: Event
 
     def __init__(
             self,
@@ -22,24 +33,31 @@ class RefreshCache(Generic[_K, _V]):
             refresh_callback: Callable[[_K, _V | None, _V], bool],
             sync_interval_seconds: int
     ) -> None:
-        self.__general_lock = RLock()
         self.__locks = {}
         self.__cache = {}
         self.__load_func = load_func
         self.__refresh_callback = refresh_callback
         self.__sync_interval_seconds = sync_interval_seconds
+        self.__stop = Event()
+        # Daemon, so that a sync stuck on network doesn't hold the process on exit; close() stops it gracefully
+        Thread(daemon=True, target=self.__schedule).start()
 
     def get(self, key: _K) -> _V:
-        (lock, just_created) = self.__get_lock(key)
+        # A plain dict read is atomic, so cache hits don't need the per-key lock
+        value = self.__cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        lock = self.__get_lock(key)
         with lock:
-            if just_created:
-                # TODO graceful shutdown & destructor (?)
-                Thread(daemon=True, target=lambda: self.__schedule(key)).start()
             if key in self.__cache:
                 return self.__cache[key]
             else:
                 return self.__load_and_save(key)
 
+    # Never loads: None unless the key has already been loaded
+    def peek(self, key: _K) -> _V | None:
+        return self.__cache.get(key)
+
     def __load_and_save(self, key: _K) -> _V:
         old_value: _V = self.__cache.get(key)
         new_value: _V = self.__load_func(key, old_value)
@@ -50,22 +68,118 @@ class RefreshCache(Generic[_K, _V]):
             self.__cache[key] = old_value
             return old_value
 
-    def __get_lock(self, key: _K) -> (RLock, bool):
-        just_created: bool = False
-        with self.__general_lock:
-            if key not in self.__locks:
-                self.__locks[key] = RLock()
-                just_created = True
-            return self.__locks[key], just_created
+    def __get_lock(self, key: _K) -> RLock:
+        lock = self.__locks.get(key)
+        if lock is None:
+            # dict.setdefault is atomic in CPython, so no general lock is needed to create a per-key lock only once
+            lock = self.__locks.setdefault(key, RLock())
+        return lock
+
+    # Stops refreshing; a pass in progress finishes its current key first
+    def close(self) -> None:
+        self.__stop.set()
+
+    # A single thread refreshes all the loaded keys in one pass per tick, so wakeups don't grow with key count
+    def __schedule(self) -> None:
+        while not self.__stop.wait(self.__sync_interval_seconds):
+            for key in list(self.__cache):
+                if self.__stop.is_set():
+                    return
+                # noinspection PyBroadException
+                try:
+                    # Locks are never removed from self.__locks, so no need to go through __get_lock
+                    with self.__locks[key]:
+                        self.__load_and_save(key)
+                except BaseException:
+                    logger.error('Failed refreshing %s', key, exc_info=True)
+
+
+# Refuses new keys with CapacityException when full instead of evicting live ones
+class LimitedTtlCache(Cache, Generic[_K, _V]):
+    __ttl: float
+    __timer: Callable[[], float]
+    # With a single TTL, the most recently set or prolonged key always expires last,
+    # so keeping keys in access order keeps them in expiration order too
+    __expirations: OrderedDict[_K, float]
+    __next_sweep_time: float
+
+    def __init__(self, maxsize: int, ttl: float, timer: Callable[[], float] = time.monotonic) -> None:
+        super().__init__(maxsize)
+        self.__ttl = ttl
+        self.__timer = timer
+        self.__expirations = OrderedDict()
+        self.__next_sweep_time = 0.0
+
+    def __contains__(self, key: _K) -> bool:
+        expiration = self.__expirations.get(key)
+        return expiration is not None and self.__timer() < expiration
+
+    def __getitem__(self, key: _K) -> _V:
+        if key not in self:
+            return self.__missing__(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key: _K, value: _V) -> None:
+        now = self.__timer()
+        # Lookups check expirations on their own, so stale values only need sweeping once in a while,
+        # or right away when they may be what keeps the new key out
+        if now >= self.__next_sweep_time or self.currsize >= self.maxsize:
+            self.__expire_at(now)
+        super().__setitem__(key, value)
+        self.__prolong(key, now)
+
+    # Returns a live value prolonging its TTL, or stores and returns a new one made by factory
+    def get_or_set(self, key: _K, factory: Callable[[], _V]) -> _V:
+        now = self.__timer()
+        expiration = self.__expirations.get(key)
+        if expiration is not None and now < expiration:
+            self.__prolong(key, now)
+            return super().__getitem__(key)
+        value = factory()
+        self[key] = value
+        return value
+
+    def __prolong(self, key: _K, now: float) -> None:
+        self.__expirations[key] = now + self.__ttl
+        self.__expirations.move_to_end(key)
+
+    def __delitem__(self, key: _K) -> None:
+        super().__delitem__(key)
+        del self.__expirations[key]
+
+    # Live keys only: expired ones are the head of the order, so only those are visited
+    def __len__(self) -> int:
+        now = self.__timer()
+        expired = 0
+        for expiration in self.__expirations.values():
+            if now < expiration:
+                break
+            expired += 1
+        return len(self.__expirations) - expired
+
+    def clear(self) -> None:
+        super().clear()
+        self.__expirations.clear()
+        self.__next_sweep_time = 0.0
+
+    def __iter__(self) -> Iterator[_K]:
+        now = self.__timer()
+        return iter([key for key, expiration in self.__expirations.items() if now < expiration])
 
-    def __schedule(self, key: _K) -> None:
-        while True:
-            time.sleep(self.__sync_interval_seconds)
-            with self.__get_lock(key)[0]:
-                self.__load_and_save(key)
+    def expire(self) -> None:
+        self.__expire_at(self.__timer())
 
+    def __expire_at(self, now: float) -> None:
+        self.__next_sweep_time = now + _SWEEP_INTERVAL_SECONDS
+        expirations = self.__expirations
+        # Only the expired head of the order is visited
+        while expirations:
+            key, expiration = next(iter(expirations.items()))
+            if now < expiration:
+                break
+            del expirations[key]
+            super().__delitem__(key)
 
-class LimitedTtlCache(TTLCache):
     def popitem(self):
         raise CapacityException()
 
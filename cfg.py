@@ -1,3 +1,4 @@
+import functools
 import os
 from dataclasses import dataclass, field
 from typing import TypeVar
@@ -5,7 +6,7 @@ from typing import TypeVar
 import yaml
 from dacite import from_dict
 
-from gitsource import GitFileLink
+from gitsource import GitFileLink, YamlLoader
 
 T = TypeVar("T")
 
@@ -28,6 +29,7 @@ class Nudge:
     job_interval_seconds: int = field(default=300)
     active_interval_seconds: int = field(default=43200)
     idling_interval_seconds: int = field(default=7200)
+    max_concurrent: int = field(default=30)
 
 
 @dataclass(frozen=True)
@@ -53,9 +55,14 @@ class CollectionDescriptor(GitFileLink):
 class PersistedConfig:
     collections: list[CollectionDescriptor]
 
+    # Built once per parsed config: a refreshed config is a new instance with its own index
+    @functools.cached_property
+    def title_by_link(self) -> dict[GitFileLink, str]:
+        return {c: c.title for c in self.collections}
+
 
 def load(file, data_class: type[T]) -> T:
-    return from_dict(data_class, yaml.safe_load(file))
+    return from_dict(data_class, yaml.load(file, Loader=YamlLoader))
 
 
 with open('deltabanana.yaml', encoding='UTF-8') as config_file:
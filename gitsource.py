@@ -1,22 +1,29 @@
+import functools
 import hashlib
 import logging
 import os.path
+from collections import defaultdict
 from dataclasses import dataclass, field
-from itertools import groupby
 from pathlib import Path
-from threading import RLock
 from typing import Any, TypeVar
 from collections.abc import Callable
 
 import yaml
 from dacite import from_dict
 from dulwich import porcelain
+from dulwich.client import get_transport_and_path
+from dulwich.object_store import tree_lookup_path
 from dulwich.porcelain import NoneStream, Error
+from dulwich.repo import Repo
 
 from caches import RefreshCache
+from locks import RLock
 
 logger = logging.getLogger(__name__)
 
+# LibYAML-backed loader when PyYAML is built with it, pure Python one otherwise
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 @dataclass(frozen=True, kw_only=True)
 class _GitRepoLink:
@@ -24,7 +31,12 @@ class _GitRepoLink:
     branch: str = field(default='main')
 
     def dir_name(self) -> str:
-        return '.gitlink_' + hashlib.md5(f'{self.url}:{self.branch}'.encode('utf-8')).hexdigest()
+        return _dir_name(self.url, self.branch)
+
+
+@functools.cache
+def _dir_name(url: str, branch: str) -> str:
+    return '.gitlink_' + hashlib.md5(f'{url}:{branch}'.encode('utf-8')).hexdigest()
 
 
 # noinspection PyDataclass
@@ -42,6 +54,7 @@ class _Change:
 @dataclass(frozen=True)
 class _CachedFiles:
     rev: str
+    # Reentrant: a mapping func run under this lock may itself get() another file from the same repo
     lock: RLock
     content: dict[str, Any]
     changes: list[_Change]
@@ -49,9 +62,12 @@ class _CachedFiles:
 
 T = TypeVar("T")
 
+# (url, branch): a plain tuple is cheaper to build and hash on every GitSource access than a _GitRepoLink
+_RepoKey = tuple[str, str]
+
 
 class GitSource:
-    __link_cache: RefreshCache[_GitRepoLink, _CachedFiles]
+    __link_cache: RefreshCache[_RepoKey, _CachedFiles]
     __refresh_callback: Callable[[str, str], None]
     __apply_changes_callback: Callable[[list[Any], GitFileLink], None]
     __no_change_sync_interval_multiplier: int
@@ -77,27 +93,49 @@ class GitSource:
             sync_interval_seconds=sync_interval_seconds
         )
 
+    def close(self) -> None:
+        self.__link_cache.close()
+
     def get(self, link: GitFileLink, mapping: Callable[[Path, GitFileLink], T] | type[T]) -> T:
+        # Parsed content is only ever added to or dropped from, never replaced in place,
+        # so already parsed files can be served without taking the repo lock
+        value = self.__cached_files(link).content.get(link.path)
+        if value is not None:
+            return value
         if type(mapping) is type:
             _T: type[T] = mapping
 
             # noinspection PyUnusedLocal
             def __parse_as_data_class(path: Path, ignore: GitFileLink) -> _T:
                 with open(path, encoding='UTF-8') as file:
-                    return from_dict(_T, yaml.safe_load(file))
+                    return from_dict(_T, yaml.load(file, Loader=YamlLoader))
             mapping = __parse_as_data_class
         return self.__locked(link, lambda f: GitSource.__get(link, f.content, mapping))
 
+    # Drops the file's parsed content, so that the next get() maps it again. Needed when a mapping depends on
+    # files elsewhere, as a sync only re-maps files whose own git objects changed. Unloaded repos are left alone
+    def forget(self, link: GitFileLink) -> None:
+        repo_key: _RepoKey = (link.url, link.branch)
+        cached_files = self.__link_cache.peek(repo_key)
+        if cached_files:
+            # A sync in the meantime replaces _CachedFiles but keeps the lock, so the current ones are re-read under it
+            with cached_files.lock:
+                cached_files = self.__link_cache.peek(repo_key)
+                if cached_files:
+                    cached_files.content.pop(link.path, None)
+
     def register_change(self, link: GitFileLink, change_content: Any) -> None:
         self.__locked(link, lambda cached_files: GitSource.__register_change(link, change_content, cached_files))
 
     def __locked(self, link: GitFileLink, action: Callable[[_CachedFiles], T]) -> T:
-        repo_link = _GitRepoLink(url=link.url, branch=link.branch)
-        with self.__link_cache.get(repo_link).lock:
-            # Lock doesn't change when created, but self.__link_cache.get(repo_link)
+        with self.__cached_files(link).lock:
+            # Lock doesn't change when created, but self.__cached_files(link)
             # can change between a retrieval of the lock from cache and lock acquisition itself.
-            # So 'doubled' self.__link_cache.get(repo_link) is needed.
-            return action(self.__link_cache.get(repo_link))
+            # So 'doubled' self.__cached_files(link) is needed.
+            return action(self.__cached_files(link))
+
+    def __cached_files(self, link: GitFileLink) -> _CachedFiles:
+        return self.__link_cache.get((link.url, link.branch))
 
     @staticmethod
     def __register_change(link: GitFileLink, change_content: Any, cached_files: _CachedFiles) -> None:
@@ -115,7 +153,8 @@ class GitSource:
             content[link.path] = new_value
             return new_value
 
-    def __sync_repo(self, link: _GitRepoLink, old_files: _CachedFiles) -> _CachedFiles:
+    def __sync_repo(self, repo_key: _RepoKey, old_files: _CachedFiles) -> _CachedFiles:
+        url, branch = repo_key
         # noinspection PyBroadException
         try:
             lock = old_files.lock if old_files else RLock()
@@ -126,32 +165,45 @@ class GitSource:
                     return old_files
                 changes: list[_Change] = old_files.changes if old_files else []
                 self.__sync_skip_count = 0
-                dir_name = link.dir_name()
+                if old_files and not changes:
+                    remote_rev = GitSource.__get_remote_rev(url, branch)
+                    if remote_rev is None:
+                        logger.error('No branch %s in %s, keeping revision %s', branch, url, old_files.rev)
+                        return old_files
+                    if remote_rev == old_files.rev:
+                        logger.info('No changes in %s, revision %s', repo_key, old_files.rev)
+                        return old_files
+                dir_name = _dir_name(url, branch)
                 if os.path.isdir(dir_name):
                     porcelain.clean(dir_name, dir_name)
-                    porcelain.reset(dir_name, 'hard')
-                    logger.info(f'Pulling {link} at path {dir_name} ...')
-                    porcelain.pull(dir_name, errstream=NoneStream())
+                    logger.info('Fetching %s at path %s ...', repo_key, dir_name)
+                    GitSource.__fetch_tip(dir_name, branch)
                 else:
-                    logger.info(f'Cloning {link} at path {dir_name} ...')
+                    logger.info('Cloning %s at path %s ...', repo_key, dir_name)
                     porcelain.clone(
-                        source=link.url,
+                        source=url,
                         target=dir_name,
-                        branch=link.branch,
+                        branch=branch,
                         depth=1,
                         errstream=NoneStream()
                     )
-                logger.info(f'Updated  {link} at revision {GitSource.__get_rev(dir_name)}')
+                rev = GitSource.__get_rev(dir_name)
+                logger.info('Updated  %s at revision %s', repo_key, rev)
                 if changes:
-                    self.__add_commit_push(link, changes)
-                return _CachedFiles(GitSource.__get_rev(dir_name), lock, {}, changes)
+                    self.__add_commit_push(repo_key, changes)
+                    rev = GitSource.__get_rev(dir_name)
+                content = GitSource.__unchanged_content(dir_name, old_files, rev) if old_files else {}
+                return _CachedFiles(rev, lock, content, changes)
         except BaseException:
-            logger.error(f'Failed syncing repo {link}', exc_info=True)
+            logger.error('Failed syncing repo %s', repo_key, exc_info=True)
 
-    def __add_commit_push(self, link: _GitRepoLink, changes: list[_Change]) -> None:
-        dir_name = link.dir_name()
-        for key, group in groupby(changes, lambda c: c.link):
-            self.__apply_changes_callback(list(map(lambda g: g.content, group)), key)
+    def __add_commit_push(self, repo_key: _RepoKey, changes: list[_Change]) -> None:
+        dir_name = _dir_name(*repo_key)
+        grouped_changes: defaultdict[GitFileLink, list[Any]] = defaultdict(list)
+        for change in changes:
+            grouped_changes[change.link].append(change.content)
+        for file_link, contents in grouped_changes.items():
+            self.__apply_changes_callback(contents, file_link)
         try:
             repo = porcelain.open_repo(os.getcwd() + '/' + dir_name)
             status = porcelain.status(repo)
@@ -160,23 +212,66 @@ class GitSource:
                 repo.stage(to_stage)
                 porcelain.commit(repo, message=self.__commit_message)
                 porcelain.push(repo, errstream=NoneStream())
-                rev = GitSource.__get_rev('.')
-                logger.info(f'After push {link} is at revision {rev}')
+                rev = repo.head().decode()
+                logger.info('After push %s is at revision %s', repo_key, rev)
             elif changes:
-                logger.warning(f'Registered changes have not made any actual change for {link}')
+                logger.warning('Registered changes have not made any actual change for %s', repo_key)
             changes.clear()
         except Error:
-            logger.warning(f'Could not push changes for {link}, will retry later', exc_info=True)
+            logger.warning('Could not push changes for %s, will retry later', repo_key, exc_info=True)
 
-    def __on_refresh(self, link: _GitRepoLink, old_files: _CachedFiles | None, new_files: _CachedFiles) -> bool:
+    def __on_refresh(self, repo_key: _RepoKey, old_files: _CachedFiles | None, new_files: _CachedFiles) -> bool:
         if old_files and (old_files.rev == new_files.rev):
             return False
-        self.__refresh_callback(link.url, link.branch)
+        self.__refresh_callback(*repo_key)
         return True
 
+    # Fetches only the branch tip and hard-resets the checkout to it,
+    # so that neither the history since the last sync is downloaded nor .git keeps growing
+    @staticmethod
+    def __fetch_tip(dir_name: str, branch: str) -> None:
+        ref = f'refs/heads/{branch}'.encode()
+        with Repo(dir_name) as repo:
+            remote_name, remote_location = porcelain.get_remote_repo(repo)
+            client, path = get_transport_and_path(remote_location, config=repo.get_config_stack())
+
+            # Only the tracked branch is wanted: porcelain.fetch would download every branch tip of the remote
+            def determine_wants(refs: dict[bytes, bytes], depth: int | None = None) -> list[bytes]:
+                return repo.object_store.determine_wants_all({ref: refs[ref]} if ref in refs else {}, depth)
+
+            result = client.fetch(path, repo, determine_wants=determine_wants, depth=1, ref_prefix=[ref])
+            tip = result.refs[ref]
+            repo.refs[f'refs/remotes/{remote_name}/{branch}'.encode()] = tip
+            repo.refs[ref] = tip
+        porcelain.reset(dir_name, 'hard', tip)
+
+    # Parsed files whose git objects are the same in both revisions are carried over instead of being parsed again
+    @staticmethod
+    def __unchanged_content(dir_name: str, old_files: _CachedFiles, rev: str) -> dict[str, Any]:
+        content: dict[str, Any] = {}
+        with Repo(dir_name) as repo:
+            try:
+                old_tree = repo[old_files.rev.encode()].tree
+                new_tree = repo[rev.encode()].tree
+            except KeyError:
+                return content
+            for path, value in old_files.content.items():
+                encoded_path = path.strip('/').encode()
+                try:
+                    if tree_lookup_path(repo.__getitem__, old_tree, encoded_path) == \
+                            tree_lookup_path(repo.__getitem__, new_tree, encoded_path):
+                        content[path] = value
+                except KeyError:
+                    pass
+        return content
+
+    # None when the remote has no such branch
+    @staticmethod
+    def __get_remote_rev(url: str, branch: str) -> str | None:
+        rev = porcelain.ls_remote(url).refs.get(f'refs/heads/{branch}'.encode())
+        return rev.decode() if rev else None
+
     @staticmethod
     def __get_rev(repo_path: str) -> str:
-        git_folder = Path(repo_path, '.git')
-        head_name = Path(git_folder, 'HEAD').read_text().split('\n')[0].split(' ')[-1]
-        head_ref = Path(git_folder, head_name)
-        return head_ref.read_text().replace('\n', '')
+        with Repo(repo_path) as repo:
+            return repo.head().decode()
@@ -0,0 +1,6 @@
+# fastrlock's RLock is a C implementation, noticeably cheaper to acquire than threading.RLock when uncontended.
+# It's an optional dependency (requirements-optional.txt), so the standard one is used when it's not installed
+try:
+    from fastrlock.rlock import RLock
+except ImportError:
+    from threading import RLock
@@ -1,11 +1,19 @@
 import asyncio
 import csv
+import functools
+import gc
 import gettext
+import hashlib
+import io
 import json
 import logging.config
+import os.path
 import pathlib
-from datetime import timedelta
-from typing import Any
+import sys
+import time
+from collections import defaultdict
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timedelta
 from typing import Final
 
 import telegram.ext.filters as filters
@@ -17,26 +25,79 @@ from telegram.ext import ContextTypes, Application, CommandHandler, JobQueue, Ca
 
 from caches import LimitedTtlCache, CapacityException
 from cfg import config, PersistedConfig
-from gitsource import GitSource, GitFileLink
+from gitsource import GitSource, GitFileLink, YamlLoader
 from state import UserState, Collection, Entry
 
 logging.config.fileConfig('logging.conf')
 logger = logging.getLogger(__name__)
 
 NEXT_BUTTON: Final[ReplyKeyboardMarkup] = ReplyKeyboardMarkup([[KeyboardButton('/next')]], resize_keyboard=True)
+REMOVE_BUTTONS: Final[ReplyKeyboardRemove] = ReplyKeyboardRemove()
+
+# Callback data is '<type>:<value>', well within Telegram's 64 bytes limit
+COLLECTION_IDX_DATA_TYPE: Final[str] = 'c'
+NUDGE_REQUEST_DATA_TYPE: Final[str] = 'n'
+NUDGE_SET: Final[str] = 'SET'
+NUDGE_RESET: Final[str] = 'RESET'
+NUDGE_HELP: Final[str] = 'HELP'
+NUDGE_SET_DATA: Final[str] = f'{NUDGE_REQUEST_DATA_TYPE}:{NUDGE_SET}'
+NUDGE_RESET_DATA: Final[str] = f'{NUDGE_REQUEST_DATA_TYPE}:{NUDGE_RESET}'
+NUDGE_HELP_DATA: Final[str] = f'{NUDGE_REQUEST_DATA_TYPE}:{NUDGE_HELP}'
+# Keyboards sent before that carry '{"type": ..., "value": ...}' JSON, and can still be pressed in users' chats
+LEGACY_DATA_TYPES: Final[dict[str, str]] = {
+    'collection_idx': COLLECTION_IDX_DATA_TYPE,
+    'nudge_request': NUDGE_REQUEST_DATA_TYPE
+}
 
 
 class Main:
     user_states: LimitedTtlCache[str, UserState]
+    # Users who have set a nudge, so that nudge_users doesn't scan every stored state
+    nudge_usernames: set[str]
+    # Users by (url, branch) of their selected collection, so that on_refresh visits only the affected ones
+    usernames_by_repo: defaultdict[tuple[str, str], set[str]]
     git_source: GitSource
     app: Application
+    # Built once, but not at module level: they need translations installed in __main__
+    nudge_set_menu: InlineKeyboardMarkup
+    nudge_reset_menu: InlineKeyboardMarkup
+    nudge_actions: dict[str, Callable[[Update, UserState], Awaitable[None]]]
+    callback_handlers: dict[str, Callable[[Update, UserState, str], Awaitable[None]]]
+    # Values derived from git content, dropped by on_refresh; the generation keeps a value built from
+    # pre-refresh content from being cached after the refresh has happened
+    collections_markup: InlineKeyboardMarkup | None
+    cached_persisted_config: PersistedConfig | None
+    refresh_generation: int
 
     def __init__(self):
         self.user_states = LimitedTtlCache(
             maxsize=config.active_user_sessions.max_count,
             ttl=config.active_user_sessions.inactivity_timeout_seconds
         )
-        app = Application.builder().token(config.bot_token).job_queue(JobQueue()).build()
+        self.nudge_usernames = set()
+        self.usernames_by_repo = defaultdict(set)
+        self.collections_markup = None
+        self.cached_persisted_config = None
+        self.refresh_generation = 0
+        self.nudge_set_menu = Main.nudge_menu(_('nudge_button_set'), NUDGE_SET_DATA)
+        self.nudge_reset_menu = Main.nudge_menu(_('nudge_button_reset'), NUDGE_RESET_DATA)
+        self.nudge_actions = {
+            NUDGE_SET: self.set_nudge,
+            NUDGE_RESET: self.reset_nudge,
+            NUDGE_HELP: self.show_nudge_help
+        }
+        self.callback_handlers = {
+            COLLECTION_IDX_DATA_TYPE: self.select_collection,
+            NUDGE_REQUEST_DATA_TYPE: self.handle_nudge_request
+        }
+        # Updates are handled concurrently, so the connection pool is sized for a burst of as many replies
+        app = Application.builder() \
+            .token(config.bot_token) \
+            .concurrent_updates(True) \
+            .connection_pool_size(256) \
+            .pool_timeout(30) \
+            .job_queue(JobQueue()) \
+            .build()
         app.add_handlers([
             MessageHandler(None, self.interaction_callback),
             CallbackQueryHandler(self.interaction_callback)
@@ -64,36 +125,38 @@ class Main:
             callback=self.nudge_users,
             interval=timedelta(seconds=config.nudge.job_interval_seconds)
         )
+        # Config, handlers and markups live as long as the bot: keep them out of the collector's scans
+        gc.freeze()
         app.run_polling(poll_interval=config.bot_poll_interval_seconds)
+        self.git_source.close()
 
     def user_state(self, update: Update) -> UserState:
         username = update.effective_user.username
-        if username not in self.user_states:
-            self.user_states[username] = UserState(update.effective_chat.id)
-            logger.info(f'Storing a new state for user {username}. Stored state count: {len(self.user_states)}')
-        else:
-            # Refresh state's TTL
-            self.user_states[username] = self.user_states[username]
-        return self.user_states[username]
+
+        created = False
+
+        def new_state() -> UserState:
+            nonlocal created
+            created = True
+            return UserState(update.effective_chat.id)
+
+        # Refreshes state's TTL on a hit
+        state: UserState = self.user_states.get_or_set(username, new_state)
+        # Logged only once stored: a full cache refuses the new state with CapacityException
+        if created:
+            logger.info('Stored a new state for user %s. Stored state count: %s', username, len(self.user_states))
+        return state
 
     # noinspection PyUnusedLocal
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.user_state(update).reset()
-        collections_keyboard: list[list[InlineKeyboardButton]] = []
-        for idx, descriptor in enumerate(self.persisted_config.collections):
-            # TODO fully-fledged authorisation check
-            if descriptor.restricted:
-                continue
-            try:
-                data = json.dumps({'type': 'collection_idx', 'value': idx})
-                button_markup = [InlineKeyboardButton(self.get_collection(idx).decorated_title, callback_data=data)]
-                collections_keyboard.append(button_markup)
-            except FileNotFoundError:
-                logger.error(f'Failed to load collection #{idx} from config file', exc_info=True)
+        state: UserState = self.user_state(update)
+        self.untrack_collection(update.effective_user.username, state.collection)
+        state.reset()
+        collections_markup: InlineKeyboardMarkup | None = await self.get_collections_markup()
         await asyncio.gather(
-            self.remove_chat_buttons(update.effective_chat.id),
-            update.message.reply_text(_('collections'), reply_markup=(InlineKeyboardMarkup(collections_keyboard))) \
-                if collections_keyboard else update.message.reply_text(
+            self.remove_next_button(state),
+            update.message.reply_text(_('collections'), reply_markup=collections_markup) \
+                if collections_markup else update.message.reply_text(
                     _('no_collections').format(
                         admin=' ' + config.admin if config.admin else '',
                         id=update.effective_user.id
@@ -101,6 +164,35 @@ class Main:
                 )
         )
 
+    async def get_collections_markup(self) -> InlineKeyboardMarkup | None:
+        markup = self.collections_markup
+        if markup is not None:
+            return markup
+        generation = self.refresh_generation
+        # TODO fully-fledged authorisation check
+        # Loaded concurrently: a cold /start would otherwise clone and parse the repos one after another
+        persisted_config: PersistedConfig = await self.get_persisted_config()
+        buttons = await asyncio.gather(*(
+            self.collection_button(idx)
+            for idx, descriptor in enumerate(persisted_config.collections) if not descriptor.restricted
+        ))
+        collections_keyboard: list[list[InlineKeyboardButton]] = [[button] for button in buttons if button]
+        if not collections_keyboard:
+            return None
+        markup = InlineKeyboardMarkup(collections_keyboard)
+        # A keyboard missing a collection that failed to load is not cached, so that the load is retried
+        if len(collections_keyboard) == len(buttons) and generation == self.refresh_generation:
+            self.collections_markup = markup
+        return markup
+
+    async def collection_button(self, idx: int) -> InlineKeyboardButton | None:
+        try:
+            title: str = (await self.get_collection(idx)).decorated_title
+            return InlineKeyboardButton(title, callback_data=f'{COLLECTION_IDX_DATA_TYPE}:{idx}')
+        except FileNotFoundError:
+            logger.error('Failed to load collection #%s from config file', idx, exc_info=True)
+            return None
+
     # noinspection PyUnusedLocal
     async def next_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         await asyncio.gather(
@@ -124,6 +216,7 @@ class Main:
         if not state.collection:
             await update.message.reply_text(_('select_collection'))
             return
+        state.next_button_shown = True
         await update.message.reply_text(_('how_to_add_entry'), parse_mode='html', reply_markup=NEXT_BUTTON)
 
     # noinspection PyUnusedLocal
@@ -131,12 +224,7 @@ class Main:
         state: UserState = self.user_state(update)
         if state.nudge_menu_msg:
             await state.delete_nudge_menu()
-        button = InlineKeyboardButton(_('nudge_button_reset'), callback_data=Main.nudge_req('RESET')) \
-            if state.nudge_is_set else InlineKeyboardButton(_('nudge_button_set'), callback_data=Main.nudge_req('SET'))
-        reply_markup = InlineKeyboardMarkup([
-            [button],
-            [InlineKeyboardButton(_('nudge_button_help'), callback_data=Main.nudge_req('HELP'))]
-        ])
+        reply_markup = self.nudge_reset_menu if state.nudge_is_set else self.nudge_set_menu
         state.nudge_menu_msg = await update.message.reply_text(_('nudge_title'), reply_markup=reply_markup)
 
     # noinspection PyUnusedLocal
@@ -155,7 +243,7 @@ class Main:
                 url=collection.link.url,
                 branch=collection.link.branch,
                 path=collection.link.path,
-                entry_count=len(collection.entries)
+                entry_count=collection.entry_count
             ),
             parse_mode='html'
         )
@@ -163,40 +251,74 @@ class Main:
     # noinspection PyUnusedLocal
     async def inline_keyboard_button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         state: UserState = self.user_state(update)
-        data: dict = json.loads(update.callback_query.data)
-        data_type: str = data['type']
-        value: Any = data['value']
-        if data_type == 'collection_idx':
-            collection = self.get_collection(int(value))
-            state.collection = collection
-            await asyncio.gather(
-                update.callback_query.answer(),
-                update.effective_message.reply_text(
-                    _('selected_collection').format(title=collection.decorated_title, topic=collection.topic),
-                    parse_mode='html',
-                    reply_markup=NEXT_BUTTON
-                )
+        data: str = update.callback_query.data
+        if data.startswith('{'):
+            data_type, value = Main.decode_legacy_data(data)
+        else:
+            data_type, ignore, value = data.partition(':')
+        handler = self.callback_handlers.get(data_type)
+        if handler:
+            await handler(update, state, value)
+        else:
+            # Unanswered, the pressed button would spin until Telegram times it out
+            logger.warning('Unknown callback data %s', data)
+            await update.callback_query.answer(_('menu_expired'), show_alert=True)
+
+    @staticmethod
+    def decode_legacy_data(data: str) -> tuple[str, str]:
+        try:
+            decoded: dict = json.loads(data)
+            return LEGACY_DATA_TYPES.get(decoded['type'], ''), str(decoded['value'])
+        except (ValueError, KeyError, TypeError):
+            return '', ''
+
+    async def select_collection(self, update: Update, state: UserState, value: str) -> None:
+        collection = await self.get_collection(int(value))
+        username: str = update.effective_user.username
+        self.untrack_collection(username, state.collection)
+        state.collection = collection
+        link: GitFileLink = collection.link
+        self.usernames_by_repo[(link.url, link.branch)].add(username)
+        state.next_button_shown = True
+        await asyncio.gather(
+            update.callback_query.answer(),
+            update.effective_message.reply_text(
+                _('selected_collection').format(title=collection.decorated_title, topic=collection.topic),
+                parse_mode='html',
+                reply_markup=NEXT_BUTTON
             )
-            await self.show_next_command(state)
-        elif data_type == 'nudge_request':
-            await update.callback_query.answer()
-            if value == 'SET':
-                state.set_nudge()
-                await asyncio.gather(
-                    state.delete_nudge_menu(),
-                    self.app.bot.send_message(state.chat_id, _('nudge_activated'))
-                )
-                if not state.collection:
-                    await self.app.bot.send_message(state.chat_id, _('nudge_remember_select_collection'))
-            elif value == 'RESET':
-                state.reset_nudge()
-                await asyncio.gather(
-                    state.delete_nudge_menu(),
-                    self.app.bot.send_message(state.chat_id, _('nudge_deactivated'))
-                )
-            else:
-                hours: int = round(config.nudge.active_interval_seconds / 3600)
-                await self.app.bot.send_message(state.chat_id, _('nudge_help_text').format(hours=hours))
+        )
+        await self.show_next_command(state)
+
+    async def handle_nudge_request(self, update: Update, state: UserState, value: str) -> None:
+        # Unknown values fall back to the help text, as before
+        await asyncio.gather(
+            update.callback_query.answer(),
+            self.nudge_actions.get(value, self.show_nudge_help)(update, state)
+        )
+
+    async def set_nudge(self, update: Update, state: UserState) -> None:
+        state.set_nudge(datetime.now())
+        self.nudge_usernames.add(update.effective_user.username)
+        await asyncio.gather(
+            state.delete_nudge_menu(),
+            self.app.bot.send_message(state.chat_id, _('nudge_activated'))
+        )
+        if not state.collection:
+            await self.app.bot.send_message(state.chat_id, _('nudge_remember_select_collection'))
+
+    async def reset_nudge(self, update: Update, state: UserState) -> None:
+        state.reset_nudge()
+        self.nudge_usernames.discard(update.effective_user.username)
+        await asyncio.gather(
+            state.delete_nudge_menu(),
+            self.app.bot.send_message(state.chat_id, _('nudge_deactivated'))
+        )
+
+    # noinspection PyUnusedLocal
+    async def show_nudge_help(self, update: Update, state: UserState) -> None:
+        hours: int = round(config.nudge.active_interval_seconds / 3600)
+        await self.app.bot.send_message(state.chat_id, _('nudge_help_text').format(hours=hours))
 
     # noinspection PyUnusedLocal
     async def non_command_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -205,6 +327,7 @@ class Main:
             await update.message.reply_text(_('select_collection'))
             return
         lines = update.message.text.splitlines()
+        state.next_button_shown = True
         if 1 < len(lines) < 4:
             self.git_source.register_change(state.collection.link, Entry(*lines, author=update.effective_user.username))
             await update.message.reply_text(_('entry_added'), reply_markup=NEXT_BUTTON)
@@ -213,14 +336,14 @@ class Main:
 
     # noinspection PyUnusedLocal
     async def interaction_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.user_state(update).update_last_interaction_time()
+        self.user_state(update).update_last_interaction_time(time.monotonic())
 
     @staticmethod
     async def error(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if isinstance(context.error, CapacityException):
             await update.message.reply_text(_('bot_busy'))
         else:
-            logger.error(f'Update {update} caused an error {context.error}', exc_info=True)
+            logger.error('Update %s caused an error %s', update, context.error, exc_info=True)
 
     async def show_next_command(self, state: UserState, stick_to_questions: bool = False):
         chat_id: int = state.chat_id
@@ -231,90 +354,180 @@ class Main:
             await self.app.bot.send_message(chat_id, _('empty_collection'))
             return
         state.roll(stick_to_questions)
-        await self.app.bot.send_message(chat_id, state.decorated_word)
+        text: str = state.decorated_word
+        # Advanced before the send: an update handled concurrently meanwhile must not show the same word again
         state.go_next_word()
+        await self.app.bot.send_message(chat_id, text)
 
     # noinspection PyUnusedLocal
     async def nudge_users(self, ctx: CallbackContext):
-        for username in self.user_states:
-            state: UserState = self.user_states.get(username)
-            if not state.collection or not state.idling or not state.is_nudge_time:
+        # Expired states are otherwise only dropped when a new user is stored
+        self.user_states.expire()
+        now = datetime.now()
+        monotonic_now = time.monotonic()
+        due: list[UserState] = []
+        # Loop invariants are bound once
+        nudge_usernames = self.nudge_usernames
+        get_state = self.user_states.get
+        for username in list(nudge_usernames):
+            state: UserState | None = get_state(username)
+            # The nudge has gone along with an expired state
+            if state is None or not state.nudge_is_set:
+                nudge_usernames.discard(username)
                 continue
-            state.update_last_interaction_time()
-            ctx.job_queue.run_once(lambda ignore: self.show_next_command(state, True), 0)
+            if not state.collection or not state.idling_at(monotonic_now) or not state.is_nudge_time_at(now):
+                continue
+            state.update_last_interaction_time(monotonic_now)
+            due.append(state)
+        if not due:
+            return
+        # Bounded, so that a crowd of due users doesn't run into Bot API flood limits all at once
+        semaphore = asyncio.Semaphore(config.nudge.max_concurrent)
+        results = await asyncio.gather(*(self.nudge(state, semaphore) for state in due), return_exceptions=True)
+        for state, result in zip(due, results):
+            if isinstance(result, Exception):
+                logger.error('Failed to nudge chat %s', state.chat_id, exc_info=result)
+
+    async def nudge(self, state: UserState, semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            await self.show_next_command(state, True)
 
     @property
     def persisted_config(self) -> PersistedConfig:
-        return self.git_source.get(config.persisted_config_link, PersistedConfig)
+        persisted_config = self.cached_persisted_config
+        if persisted_config is None:
+            generation = self.refresh_generation
+            persisted_config = self.git_source.get(config.persisted_config_link, PersistedConfig)
+            if generation == self.refresh_generation:
+                self.cached_persisted_config = persisted_config
+        return persisted_config
 
-    def get_collection(self, idx) -> Collection:
-        return self.git_source.get(self.persisted_config.collections[idx], self.parse_collection)
+    # A cold or just invalidated config is loaded from its repo, possibly after a git clone or fetch,
+    # so it must not block the event loop
+    async def get_persisted_config(self) -> PersistedConfig:
+        persisted_config = self.cached_persisted_config
+        if persisted_config is not None:
+            return persisted_config
+        return await asyncio.to_thread(lambda: self.persisted_config)
+
+    # A cache miss reads and parses files, possibly after a git clone, so it must not block the event loop.
+    # Neither must the config lookup resolving the collection's link
+    async def get_collection(self, idx) -> Collection:
+        return await asyncio.to_thread(self.load_collection, idx)
+
+    def load_collection(self, idx: int) -> Collection:
+        link: GitFileLink = self.persisted_config.collections[idx]
+        return self.git_source.get(link, self.parse_collection)
 
     # noinspection PyTypeChecker
     def parse_collection(self, path: pathlib.Path, link: GitFileLink) -> Collection:
-        content: list[Entry] = []
-        with open(path.joinpath('entries.csv'), encoding='utf-8') as csv_file:
-            for row in csv.reader(csv_file, delimiter=';'):
-                content.append(Entry(*row))
-        with open(path.joinpath('description.yaml'), encoding='UTF-8') as yaml_file:
-            descr: dict = yaml.safe_load(yaml_file)
-            title: str | None = None
-            for ignore, c in enumerate(self.persisted_config.collections):
-                if c == link:
-                    title = c.title
-            if title is None:
-                raise IndexError()
-            return Collection(tuple(content), descr['nativeLang'], descr['studiedLang'], descr['topic'], link, title)
+        # Files are read as bytes once, so that the digest and the parsers see the same content
+        digest = hashlib.blake2b(digest_size=16)
+        # os.path.join builds a plain str, skipping the PurePath parsing joinpath does for each file
+        with open(os.path.join(path, 'entries.csv'), 'rb') as csv_file:
+            csv_bytes: bytes = csv_file.read()
+        digest.update(csv_bytes)
+        with io.TextIOWrapper(io.BytesIO(csv_bytes), encoding='utf-8', newline='') as csv_text:
+            # Blank lines and entries missing either word have nothing to show
+            entries = (Entry(*row) for row in csv.reader(csv_text, delimiter=';') if len(row) > 1)
+            content: tuple[Entry, ...] = tuple(entry for entry in entries if entry[0] and entry[1])
+        # Interned, as pronunciation hints and short words tend to repeat across entries
+        columns = tuple(tuple(word and sys.intern(word) for word in (entry[i] for entry in content)) for i in range(3))
+        with open(os.path.join(path, 'description.yaml'), 'rb') as yaml_file:
+            yaml_bytes: bytes = yaml_file.read()
+        digest.update(yaml_bytes)
+        descr: dict = yaml.load(yaml_bytes, Loader=YamlLoader)
+        title: str = self.persisted_config.title_by_link[link]
+        return Collection(
+            columns,
+            # Only a handful of languages and topics repeat across all the collections
+            sys.intern(descr['nativeLang']),
+            sys.intern(descr['studiedLang']),
+            sys.intern(descr['topic']),
+            link,
+            title,
+            digest.digest()
+        )
 
     # noinspection PyUnusedLocal
     def on_refresh(self, url: str, branch: str) -> None:
+        self.refresh_generation += 1
+        self.collections_markup = None
         pcl = config.persisted_config_link
         if (url, branch) == (pcl.url, pcl.branch):
+            self.cached_persisted_config = None
+            # Parsed collections bake in their titles from the persisted config, which the collection repos'
+            # syncs don't see change
+            forget = self.git_source.forget
+            for link in self.persisted_config.collections:
+                forget(link)
             return
-        for username in self.user_states:
-            state: UserState = self.user_states.get(username)
-            if not state.collection:
-                continue
-            link: GitFileLink = state.collection.link
-            if (url, branch) != (link.url, link.branch):
+        # Loop invariants are bound once
+        get_state = self.user_states.get
+        get_file = self.git_source.get
+        parse_collection = self.parse_collection
+        run_once = self.app.job_queue.run_once
+        notify_collection_updated = self.notify_collection_updated
+        usernames: set[str] = self.usernames_by_repo.get((url, branch), set())
+        # A snapshot: handlers on the event loop may change the set meanwhile
+        for username in list(usernames):
+            state: UserState | None = get_state(username)
+            collection: Collection | None = state.collection if state else None
+            link: GitFileLink | None = collection.link if collection else None
+            # Expired states and states switched to another repo don't untrack themselves, so they are pruned here
+            if link is None or url != link.url or branch != link.branch:
+                usernames.discard(username)
                 continue
             try:
-                state.collection = self.git_source.get(link, self.parse_collection)
-                self.app.job_queue.run_once(
-                    lambda ignore: self.app.bot.send_message(
-                        state.chat_id,
-                        _('collection_updated')
-                    ),
-                    0
-                )
+                new_collection: Collection = get_file(link, parse_collection)
+                state.update_collection(new_collection)
+                # A new revision of the repo may leave this collection's files untouched
+                if new_collection.digest == collection.digest:
+                    continue
+                # partial binds this iteration's chat: a closure would see the last one
+                run_once(functools.partial(notify_collection_updated, state.chat_id), 0)
             except FileNotFoundError:
-                logger.error(f'Failed to refresh collection {link}', exc_info=True)
+                logger.error('Failed to refresh collection %s', link, exc_info=True)
+
+    def untrack_collection(self, username: str, collection: Collection | None) -> None:
+        if collection:
+            self.usernames_by_repo[(collection.link.url, collection.link.branch)].discard(username)
+
+    # noinspection PyUnusedLocal
+    async def notify_collection_updated(self, chat_id: int, ctx: CallbackContext) -> None:
+        await self.app.bot.send_message(chat_id, _('collection_updated'))
+
+    # The ghost message costs two Bot API calls, so it's only sent while the chat has the /next button
+    async def remove_next_button(self, state: UserState) -> None:
+        if state.next_button_shown:
+            await self.remove_chat_buttons(state.chat_id)
+            # Only once removed: after a failed call the button is still on screen, and removal is retried next time
+            state.next_button_shown = False
 
     async def remove_chat_buttons(self, chat_id: int, msg_text: str = '👻'):
-        msg = await self.app.bot.send_message(chat_id, msg_text, reply_markup=ReplyKeyboardRemove())
+        msg = await self.app.bot.send_message(chat_id, msg_text, reply_markup=REMOVE_BUTTONS)
         await msg.delete()
 
     @staticmethod
-    def nudge_req(value: str) -> str:
-        return json.dumps({'type': 'nudge_request', 'value': value})
+    def nudge_menu(button_text: str, callback_data: str) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton(button_text, callback_data=callback_data)],
+            [InlineKeyboardButton(_('nudge_button_help'), callback_data=NUDGE_HELP_DATA)]
+        ])
 
     @staticmethod
     def append_entries_to_file(entries: list[Entry], link: GitFileLink) -> None:
         path = f'{link.dir_name()}/{link.path}/entries.csv'
-        logger.info(f'Appending {entries} to {path}')
-        with open(path, 'a', encoding='utf-8') as file:
-            if Main.need_to_add_new_line(path):
-                file.write('\n')
-            csv.writer(file, delimiter=';', lineterminator='\n').writerows(entries)
-
-    @staticmethod
-    def need_to_add_new_line(path: str) -> bool:
-        with open(path, 'r') as file:
-            file.seek(0, 2)
-            if file.tell() == 0:
-                return False
-            file.seek(file.tell() - 1)
-            return file.read(1) != '\n'
+        logger.info('Appending %s to %s', entries, path)
+        # A single handle both probes the last byte and appends, always at the end of file in 'ab+' mode
+        with open(path, 'ab+') as file:
+            end = file.seek(0, io.SEEK_END)
+            if end > 0:
+                file.seek(end - 1)
+                if file.read(1) != b'\n':
+                    file.write(b'\n')
+            with io.TextIOWrapper(file, encoding='utf-8', newline='') as text_file:
+                csv.writer(text_file, delimiter=';', lineterminator='\n').writerows(entries)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,6 @@
 import datetime
-import functools
+import time
+from array import array
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from random import shuffle
@@ -11,53 +12,88 @@ from cfg import config
 from gitsource import GitFileLink
 from timeinterval import TimeInterval
 
+# Column shown at each tuple_idx, indexed by reverse mode: reverse mode swaps the studied and native words
+_COLUMN_IDX_BY_MODE: tuple[tuple[int, int, int], tuple[int, int, int]] = ((0, 1, 2), (1, 0, 2))
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, slots=True)
 class Entry:
     studied: str
     native: str
     pronunciation: str | None = field(default=None)
     author: str | None = field(default=None)
+    # Stripped (studied, native, pronunciation): each is indexed several times per parsed row
+    stripped: tuple[str | None, str | None, str | None] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        stripped = tuple(v.strip() if v else None for v in (self.studied, self.native, self.pronunciation))
+        object.__setattr__(self, 'stripped', stripped)
 
-    @functools.cache
     def __getitem__(self, idx: int) -> str | None:
-        value = (self.studied, self.native, self.pronunciation)[idx] if 0 <= idx < 3 else None
-        return value.strip() if value else None
+        return self.stripped[idx] if 0 <= idx < 3 else None
 
-    @functools.cache
     def __iter__(self) -> iter:
         return iter((self.studied, self.native, self.pronunciation, self.author))
 
 
-@dataclass(frozen=True)
+# Identified by its link: generated equality and hashing would walk all the entries
+@dataclass(frozen=True, slots=True, eq=False)
 class Collection:
-    entries: tuple[Entry]
+    # Column-wise (studied, native, pronunciation) values: a word lookup touches a single column
+    columns: tuple[tuple[str | None, ...], tuple[str | None, ...], tuple[str | None, ...]]
     native_lang: str
     studied_lang: str
     topic: str
     link: GitFileLink
     title: str
+    # Of the collection's files: tells a changed collection from one just re-read after an unrelated commit
+    digest: bytes
+    # Shown on every /start button, so formatted once per parsed collection
+    decorated_title: str = field(init=False)
+    # Icon and separating space per column, prepended to every shown word
+    icon_prefixes: tuple[str, str, str] = field(init=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, 'decorated_title', f'{self.title} {self.native_lang} {self.studied_lang}')
+        object.__setattr__(self, 'icon_prefixes', (self.studied_lang + ' ', self.native_lang + ' ', '👂 '))
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, Collection) and self.link == other.link
+
+    def __hash__(self) -> int:
+        return hash(self.link)
 
     @property
-    def decorated_title(self) -> str:
-        return f'{self.title} {self.native_lang} {self.studied_lang}'
+    def entry_count(self) -> int:
+        return len(self.columns[0])
 
 
 class UserState:
+    # Private names in __slots__ are mangled just like the attributes themselves
+    __slots__ = (
+        '__collection', '__order', '__entry_count', '__entry_idx', '__tuple_idx', '__chat_id', '__reverse_mode',
+        '__last_interaction_time', '__nudge_time_interval', '__nudge_menu_msg', '__next_button_shown'
+    )
     __collection: Collection | None
-    __mutable_entries: list[Entry]
+    # Shuffled entry indices, so that sessions don't copy the collection itself; packed as C unsigned ints
+    __order: array
+    __entry_count: int
     __entry_idx: int
     __tuple_idx: int
     __chat_id: int
     __reverse_mode: bool
-    __last_interaction_time: datetime
+    # time.monotonic() value: idling is measured in elapsed seconds, immune to wall clock changes
+    __last_interaction_time: float
     __nudge_time_interval: TimeInterval | None
     __nudge_menu_msg: Any
+    __next_button_shown: bool
 
     def __init__(self, chat_id: int):
         self.__chat_id = chat_id
         self.__nudge_time_interval = None
         self.__nudge_menu_msg = None
+        # Unknown for a new state, e.g. after a restart, so it's assumed that the chat has the button
+        self.__next_button_shown = True
         self.reset()
 
     @property
@@ -67,14 +103,14 @@ class UserState:
     def reset(self) -> None:
         self.__collection = None
         self.__reverse_mode = False
-        self.__last_interaction_time = datetime.now()
+        self.__last_interaction_time = time.monotonic()
 
     def reset_nudge(self) -> None:
         self.__nudge_time_interval = None
 
-    def set_nudge(self) -> None:
+    def set_nudge(self, now: datetime) -> None:
         self.__nudge_time_interval = TimeInterval(
-            datetime.now().time(),
+            now.time(),
             timedelta(seconds=config.nudge.active_interval_seconds)
         )
 
@@ -89,16 +125,27 @@ class UserState:
     @collection.setter
     def collection(self, collection: Collection) -> None:
         self.__collection = collection
-        self.__mutable_entries = list(collection.entries)
+        self.__entry_count = collection.entry_count
+        self.__order = array('I', range(self.__entry_count))
         self.shuffle_entries()
 
+    # Keeps the shuffled order and position when an updated collection has as many entries as the current one
+    def update_collection(self, collection: Collection) -> None:
+        if self.__collection is None or collection.entry_count != self.__entry_count:
+            self.collection = collection
+        else:
+            self.__collection = collection
+            # The current word must never be empty: the update may have dropped the pronunciation to be shown next
+            if self.__tuple_idx == 2 and not self.__pronunciation:
+                self.__go_next_entry()
+
     @property
     def has_entries(self) -> bool:
-        return len(self.__mutable_entries) > 0
+        return self.__entry_count > 0
 
     @property
     def current_word(self) -> str | None:
-        return self.__mutable_entries[self.__entry_idx][self.__tuple_idx_with_mode_applied]
+        return self.__collection.columns[self.__tuple_idx_with_mode_applied][self.__order[self.__entry_idx]]
 
     @property
     def reverse_mode(self) -> bool:
@@ -110,47 +157,55 @@ class UserState:
 
     def go_next_word(self) -> None:
         self.__tuple_idx = self.__tuple_idx + 1
-        if self.__tuple_idx == 3:
-            self.__tuple_idx = 0
-            self.__entry_idx = self.__entry_idx + 1
-            if self.__entry_idx == len(self.__mutable_entries):
-                self.__entry_idx = 0
+        if self.__tuple_idx == 3 or self.__tuple_idx == 2 and not self.__pronunciation:
+            self.__go_next_entry()
 
+    # Collections have no entries without studied or native word, and go_next_word skips missing pronunciations,
+    # so the current word is never empty and only a question has to be rolled to
     def roll(self, stick_to_question: bool) -> None:
-        while not self.current_word or stick_to_question and self.__tuple_idx_with_mode_applied > 0:
-            self.go_next_word()
+        if stick_to_question and self.__tuple_idx > 0:
+            self.__go_next_entry()
+
+    def __go_next_entry(self) -> None:
+        self.__tuple_idx = 0
+        self.__entry_idx = self.__entry_idx + 1
+        if self.__entry_idx == self.__entry_count:
+            self.__entry_idx = 0
+
+    @property
+    def __pronunciation(self) -> str | None:
+        return self.__collection.columns[2][self.__order[self.__entry_idx]]
 
     def reset_collection(self) -> None:
         self.__entry_idx = 0
         self.__tuple_idx = 0
 
     def shuffle_entries(self) -> None:
-        shuffle(self.__mutable_entries)
+        if self.__entry_count > 1:
+            shuffle(self.__order)
         self.reset_collection()
 
     @property
     def decorated_word(self) -> str:
-        c = self.collection
-        native_studied_pronunciation_icon = [c.studied_lang, c.native_lang, '👂'][self.__tuple_idx_with_mode_applied]
-        question_answer_icon = '❓' if self.__tuple_idx == 0 else ''
-        return f'{native_studied_pronunciation_icon} {self.current_word} {question_answer_icon}'
+        c = self.__collection
+        idx = self.__tuple_idx_with_mode_applied
+        question_answer_suffix = ' ❓' if self.__tuple_idx == 0 else ' '
+        return c.icon_prefixes[idx] + c.columns[idx][self.__order[self.__entry_idx]] + question_answer_suffix
 
-    @property
-    def idling(self) -> bool:
-        return datetime.now() - self.__last_interaction_time > timedelta(seconds=config.nudge.idling_interval_seconds)
+    def idling_at(self, monotonic_now: float) -> bool:
+        return monotonic_now - self.__last_interaction_time > config.nudge.idling_interval_seconds
 
-    @property
-    def is_nudge_time(self) -> bool:
+    def is_nudge_time_at(self, now: datetime) -> bool:
         if not self.__nudge_time_interval:
             return False
-        return self.__nudge_time_interval.covers(datetime.now())
+        return self.__nudge_time_interval.covers(now)
 
-    def update_last_interaction_time(self) -> None:
-        self.__last_interaction_time = datetime.now()
+    def update_last_interaction_time(self, monotonic_now: float) -> None:
+        self.__last_interaction_time = monotonic_now
 
     @property
     def __tuple_idx_with_mode_applied(self) -> int:
-        return 1 - self.__tuple_idx if self.__tuple_idx < 2 and self.__reverse_mode else self.__tuple_idx
+        return _COLUMN_IDX_BY_MODE[self.__reverse_mode][self.__tuple_idx]
 
     @property
     def nudge_menu_msg(self) -> Any:
@@ -160,6 +215,14 @@ class UserState:
     def nudge_menu_msg(self, msg: Any) -> None:
         self.__nudge_menu_msg = msg
 
+    @property
+    def next_button_shown(self) -> bool:
+        return self.__next_button_shown
+
+    @next_button_shown.setter
+    def next_button_shown(self, shown: bool) -> None:
+        self.__next_button_shown = shown
+
     async def delete_nudge_menu(self) -> None:
         if self.__nudge_menu_msg is not None:
             try:
@@ -0,0 +1,49 @@
+import unittest
+
+from caches import LimitedTtlCache
+
+
+class _Timer:
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class LimitedTtlCacheTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.timer = _Timer()
+        self.cache: LimitedTtlCache[str, int] = LimitedTtlCache(maxsize=10, ttl=5, timer=self.timer)
+
+    def test_clear_forgets_keys(self) -> None:
+        self.cache['y'] = 1
+        self.cache.clear()
+        self.assertNotIn('y', self.cache)
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual(2, self.cache.get_or_set('y', lambda: 2))
+        self.assertIn('y', self.cache)
+
+    def test_expired_keys_are_neither_contained_nor_counted(self) -> None:
+        self.cache['x'] = 1
+        self.timer.now = 3
+        self.cache['y'] = 2
+        self.timer.now = 6
+        self.assertNotIn('x', self.cache)
+        self.assertIn('y', self.cache)
+        self.assertEqual(1, len(self.cache))
+
+    def test_get_or_set_prolongs_live_key_and_replaces_expired_one(self) -> None:
+        self.cache['x'] = 1
+        self.timer.now = 4
+        self.assertEqual(1, self.cache.get_or_set('x', lambda: 2))
+        self.timer.now = 8
+        self.assertEqual(1, self.cache.get_or_set('x', lambda: 2))
+        self.timer.now = 20
+        self.assertEqual(3, self.cache.get_or_set('x', lambda: 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+from state import Collection, UserState
+
+
+def _collection(pronunciations: tuple[str | None, ...]) -> Collection:
+    count = len(pronunciations)
+    columns = (tuple(f's{i}' for i in range(count)), tuple(f'n{i}' for i in range(count)), pronunciations)
+    return Collection(columns, 'N', 'S', 'topic', None, 'title', b'')
+
+
+class UpdateCollectionTest(unittest.TestCase):
+
+    def test_dropped_pronunciation_of_current_entry_is_skipped(self) -> None:
+        state = UserState(1)
+        state.collection = _collection(('p0', 'p1'))
+        state.go_next_word()
+        state.go_next_word()
+        self.assertTrue(state.decorated_word.startswith('👂 '))
+        state.update_collection(_collection((None, None)))
+        state.roll(False)
+        self.assertTrue(state.decorated_word.startswith('S '))
+
+
+if __name__ == '__main__':
+    unittest.main()
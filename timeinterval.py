@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import time, datetime, timedelta
 
 
@@ -6,7 +6,19 @@ from datetime import time, datetime, timedelta
 class TimeInterval:
     from_time: time
     span: timedelta
+    # Seconds of day: covers() runs per nudged user on every nudge tick, so it compares plain numbers
+    # instead of building datetimes
+    from_seconds: float = field(init=False, repr=False, compare=False)
+    until_seconds: float = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        from_seconds = _seconds_of_day(self.from_time)
+        object.__setattr__(self, 'from_seconds', from_seconds)
+        object.__setattr__(self, 'until_seconds', from_seconds + self.span.total_seconds())
 
     def covers(self, dt: datetime) -> bool:
-        from_datetime: datetime = datetime.combine(dt, self.from_time)
-        return from_datetime <= dt < from_datetime + self.span
+        return self.from_seconds <= _seconds_of_day(dt) < self.until_seconds
+
+
+def _seconds_of_day(t: time | datetime) -> float:
+    return t.hour * 3600 + t.minute * 60 + t.second + t.microsecond / 1_000_000